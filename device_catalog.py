@@ -0,0 +1,228 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Device fields that rarely change, kept on disk and loaded on first access
+STATIC_KEYS = frozenset(['extra', 'settings', 'family', 'brandName', 'brandLogoUrl', 'showBrand',
+                         'productModel', 'deviceUrl', 'devConfig', 'shareUsersInfo', 'createdAt'])
+STATIC_PARAMS = frozenset(['configure', 'pulses', 'bindInfos'])
+
+
+class LazyDict(dict):
+    """
+    A dict holding the hot fields, the static ones are loaded with `load()` the first time
+    one of them is accessed, or when the whole dict is walked (iteration, items(), len(),
+    copy(), dict(...), json.dumps(...)), so it always behaves like the full device.
+    """
+    __slots__ = ('_lazy_keys', '_load')
+
+    def __init__(self, data, lazy_keys, load):
+        super().__init__(data)
+        self._lazy_keys = lazy_keys
+        self._load = load
+
+    def _load_all(self):
+        if self._load is not None:
+            load, self._load = self._load, None
+            for name, value in load().items():
+                self.setdefault(name, value)
+
+    def _materialize(self, key):
+        if self._load is not None and key in self._lazy_keys and not dict.__contains__(self, key):
+            self._load_all()
+
+    def __missing__(self, key):
+        if self._load is None or key not in self._lazy_keys:
+            raise KeyError(key)
+        self._materialize(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        if self._load is not None and key in self._lazy_keys:
+            self._materialize(key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if self._load is not None and key in self._lazy_keys:
+            self._materialize(key)
+        return dict.get(self, key, default)
+
+    def __iter__(self):
+        self._load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load_all()
+        return dict.__len__(self)
+
+    def __bool__(self):
+        # `if params:` / `params or {}` must not load the metadata
+        return self._load is not None or dict.__len__(self) > 0
+
+    def keys(self):
+        self._load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def copy(self):
+        self._load_all()
+        return dict(dict.items(self))
+
+    def __repr__(self):
+        self._load_all()
+        return dict.__repr__(self)
+
+
+def hot_state(device):
+    """A plain copy of the fields already in memory, without loading the metadata of a LazyDict device"""
+    if not isinstance(device, LazyDict):
+        return device
+    hot = dict(dict.items(device))
+    if isinstance(hot.get('params'), LazyDict):
+        hot['params'] = dict(dict.items(hot['params']))
+    return hot
+
+
+def split_device(device):
+    """Split a device of the REST device list into (hot device, static metadata)"""
+    params = device.get('params') or {}
+    hot = {key: value for key, value in device.items() if key not in STATIC_KEYS}
+    hot['params'] = {key: value for key, value in params.items() if key not in STATIC_PARAMS}
+    metadata = {
+        'device': {key: device[key] for key in STATIC_KEYS if key in device},
+        'params': {key: params[key] for key in STATIC_PARAMS if key in params}
+    }
+    return hot, metadata
+
+
+class DeviceCatalog:
+    """
+    On-disk (SQLite) catalog of the static device metadata (extra, settings, family,
+    configure / pulses, brandName, ...) plus the last known hot state of every device.
+
+    The devices handed back keep only the hot fields in memory, the metadata is
+    read from the catalog the first time one of its fields is accessed.
+
+    Storing a downloaded list only splits the devices, new devices get their
+    metadata written right away. The metadata revisions (a hash of the content)
+    and the hot state are checked every `save_interval` seconds and on close(),
+    and only the rows that changed are written.
+    """
+
+    def __init__(self, path, save_interval=300):
+        self.path = path
+        self.save_interval = save_interval
+        self._revisions = {}   # deviceid -> metadata revision on disk
+        self._hot_hashes = {}  # deviceid -> hash of the hot state on disk
+        self._latest = []      # (deviceid, position, hot) of the last stored list
+        self._saved_at = None  # time.monotonic() of the last check
+        self.metadata_loads = 0  # metadata() calls, the hot path (seed / reconcile) must not make any
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS devices (
+                deviceid TEXT PRIMARY KEY,
+                position INTEGER,
+                revision TEXT,
+                metadata TEXT,
+                hot TEXT,
+                updated REAL
+            )""")
+        self._db.commit()
+        for deviceid, revision in self._db.execute("SELECT deviceid, revision FROM devices"):
+            self._revisions[deviceid] = revision
+
+    def store(self, devices):
+        """Save a downloaded device list, return it with only the hot fields in memory"""
+        now = time.monotonic()
+        check = self._saved_at is None or now - self._saved_at >= self.save_interval
+        result = []
+        latest = []
+        metadata_rows = []
+
+        for position, device in enumerate(devices):
+            deviceid = device['deviceid']
+            hot, metadata = split_device(device)
+            if check or deviceid not in self._revisions:
+                encoded = json.dumps(metadata, ensure_ascii=False)
+                revision = hashlib.sha1(encoded.encode()).hexdigest()
+                if self._revisions.get(deviceid) != revision:
+                    metadata_rows.append((deviceid, revision, encoded))
+            latest.append((deviceid, position, hot))
+            result.append(self._lazy_device(deviceid, hot))
+
+        with self._lock:
+            self._latest = latest
+            self._db.executemany("""
+                INSERT INTO devices (deviceid, revision, metadata) VALUES (?, ?, ?)
+                ON CONFLICT(deviceid) DO UPDATE SET revision = excluded.revision, metadata = excluded.metadata""",
+                metadata_rows)
+            for deviceid, revision, _ in metadata_rows:
+                self._revisions[deviceid] = revision
+
+            # forget the devices removed from the account
+            removed = set(self._revisions) - {row[0] for row in latest}
+            self._db.executemany("DELETE FROM devices WHERE deviceid = ?", [(deviceid,) for deviceid in removed])
+            for deviceid in removed:
+                del self._revisions[deviceid]
+                self._hot_hashes.pop(deviceid, None)
+
+            if check:
+                self._save_hot()
+                self._saved_at = now
+            self._db.commit()
+
+        return result
+
+    def _save_hot(self):
+        """Write the hot state of the devices that changed since the last save"""
+        now = time.time()
+        rows = []
+        for deviceid, position, hot in self._latest:
+            encoded = json.dumps(hot, ensure_ascii=False)
+            fingerprint = hash((position, encoded))
+            if self._hot_hashes.get(deviceid) != fingerprint:
+                rows.append((deviceid, position, encoded, now))
+                self._hot_hashes[deviceid] = fingerprint
+        self._db.executemany("""
+            INSERT INTO devices (deviceid, position, hot, updated) VALUES (?, ?, ?, ?)
+            ON CONFLICT(deviceid) DO UPDATE SET position = excluded.position, hot = excluded.hot, updated = excluded.updated""",
+            rows)
+
+    def load(self):
+        """Return the last stored device list (hot state only) and its time (epoch seconds, None if empty)"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT deviceid, hot, updated FROM devices WHERE hot IS NOT NULL ORDER BY position").fetchall()
+        if not rows:
+            return [], None
+        return [self._lazy_device(deviceid, json.loads(hot)) for deviceid, hot, _ in rows], min(row[2] for row in rows)
+
+    def metadata(self, deviceid):
+        """Return the static metadata of a device, {'device': {...}, 'params': {...}}"""
+        with self._lock:
+            self.metadata_loads += 1
+            row = self._db.execute("SELECT metadata FROM devices WHERE deviceid = ?", (deviceid,)).fetchone()
+        if not row or not row[0]:
+            return {'device': {}, 'params': {}}
+        return json.loads(row[0])
+
+    def close(self):
+        """Save the latest hot state and close the database"""
+        with self._lock:
+            self._save_hot()
+            self._db.commit()
+            self._db.close()
+
+    def _lazy_device(self, deviceid, hot):
+        params = LazyDict(hot.get('params') or {}, STATIC_PARAMS, lambda: self.metadata(deviceid)['params'])
+        return LazyDict(dict(hot, params=params), STATIC_KEYS, lambda: self.metadata(deviceid)['device'])
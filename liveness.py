@@ -0,0 +1,148 @@
+import time
+import logging
+import threading
+from collections import deque
+
+
+class LivenessDetector:
+    """
+    Single liveness check for the websocket, replacing fixed-interval pings.
+
+    - Any inbound frame proves the connection is alive, so a ping is only sent
+      after `idle_interval` seconds without traffic (no keepalive on a busy socket).
+    - The idle interval starts at 30 seconds and doubles after every answered ping,
+      up to `max_idle_interval` (120 seconds, never above the server hbInterval),
+      and drops back to the start value after a stall. A fully idle connection
+      settles at one ping every 2 minutes instead of the old 25 second app ping.
+      The price is detection time: a socket that dies while idle is noticed at the
+      next ping, up to max_idle_interval + timeout later (the backup polling of
+      the monitor still picks up state changes meanwhile). Busy sockets aren't
+      affected.
+    - The ping / pong round trip time is tracked with the usual smoothed RTT and
+      RTT variance (RFC 6298), the pong timeout is srtt + 4 * rttvar clamped to
+      [min_timeout, max_timeout], so a half-open socket is detected within a few
+      seconds of the ping instead of minutes.
+    - Every decision (ping, pong, stall) is kept in `decisions` for tuning.
+    """
+
+    def __init__(self, send_ping, on_stall, idle_interval=30, max_idle_interval=120, min_timeout=2, max_timeout=20,
+                 initial_rtt=1.0, tick_interval=0.5):
+        self.send_ping = send_ping  # () -> None, sends a ping frame
+        self.on_stall = on_stall    # (reason) -> None, called when the connection is considered dead
+        self.base_idle_interval = idle_interval
+        self.idle_interval = idle_interval
+        self.max_idle_interval = max_idle_interval
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.initial_rtt = initial_rtt
+        self.tick_interval = tick_interval
+        self.rtts = deque(maxlen=200)      # recent RTT samples in seconds
+        self.decisions = deque(maxlen=200)  # (time, decision, details) for tuning
+        self.pings_sent = 0
+        self.stalls = 0
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, now=None):
+        """Start over for a new connection (the RTT estimate is kept)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.last_received = now
+            self.ping_sent_at = None
+            if not self.rtts:
+                self.srtt = self.initial_rtt
+                self.rttvar = self.initial_rtt / 2
+
+    @property
+    def timeout(self):
+        """Seconds to wait for a pong before declaring a stall"""
+        return min(self.max_timeout, max(self.min_timeout, self.srtt + 4 * self.rttvar))
+
+    def set_server_interval(self, seconds):
+        """Never stay idle longer than the heartbeat interval the server asks for"""
+        if seconds and seconds < self.max_idle_interval:
+            with self._lock:
+                self.max_idle_interval = seconds
+                self.base_idle_interval = min(self.base_idle_interval, seconds)
+                self.idle_interval = min(self.idle_interval, seconds)
+                self._decide(time.monotonic(), 'idle_interval', {'seconds': self.idle_interval, 'max': seconds})
+
+    def on_receive(self, now=None):
+        """Call for every inbound frame"""
+        self.last_received = time.monotonic() if now is None else now
+
+    def on_pong(self, now=None):
+        """Call when a pong arrives, updates the RTT estimate"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.last_received = now
+            if self.ping_sent_at is None:
+                return
+            rtt = now - self.ping_sent_at
+            self.ping_sent_at = None
+            if self.rtts:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            else:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            self.rtts.append(rtt)
+            self._decide(now, 'pong', {'rtt': rtt, 'timeout': self.timeout})
+
+            # the connection survived the idle time, wait longer before the next ping
+            if self.idle_interval < self.max_idle_interval:
+                self.idle_interval = min(self.max_idle_interval, self.idle_interval * 2)
+                self._decide(now, 'idle_interval', {'seconds': self.idle_interval})
+
+    def tick(self, now=None):
+        """Call periodically (every tick_interval) while connected"""
+        now = time.monotonic() if now is None else now
+        stalled = None
+        with self._lock:
+            if self.ping_sent_at is not None:
+                waited = now - self.ping_sent_at
+                if waited <= self.timeout:
+                    return
+                self.ping_sent_at = None
+                if self.last_received >= now - waited:
+                    # the pong got lost but other frames prove the connection is alive
+                    self._decide(now, 'pong_missed', {'waited': waited})
+                    return
+                stalled = f"no pong and no other frame within {self.timeout:.1f}s"
+                self.stalls += 1
+                self.idle_interval = self.base_idle_interval
+                self._decide(now, 'stall', {'reason': stalled, 'idle': now - self.last_received})
+            elif now - self.last_received >= self.idle_interval:
+                self.ping_sent_at = now
+                self.pings_sent += 1
+                self._decide(now, 'ping', {'idle': now - self.last_received, 'timeout': self.timeout})
+            else:
+                return
+
+        if stalled:
+            self.on_stall(stalled)
+            return
+
+        try:
+            self.send_ping()
+        except Exception as e:
+            logging.error(f"Error sending ping: {e}")
+
+    def stats(self):
+        """Current estimate and counters, for tuning"""
+        rtts = sorted(self.rtts)
+        return {
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'timeout': self.timeout,
+            'idle_interval': self.idle_interval,
+            'rtt_p50': rtts[len(rtts) // 2] if rtts else None,
+            'rtt_p95': rtts[min(len(rtts) - 1, int(len(rtts) * 0.95))] if rtts else None,
+            'pings_sent': self.pings_sent,
+            'pongs': len(self.rtts),
+            'stalls': self.stalls
+        }
+
+    def _decide(self, now, decision, details):
+        self.decisions.append((now, decision, details))
+        logging.debug(f"Liveness: {decision} {details}")
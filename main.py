@@ -1,4 +1,4 @@
-import sonoff
+import sonoff_backup as sonoff  # patched client (see README), replaces the sonoff-python package
 import config
 
 print('------ config ------')
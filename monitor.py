@@ -1,8 +1,9 @@
-import sonoff
+import sonoff_backup as sonoff  # patched client (see README), replaces the sonoff-python package
 import config
 import time
 import argparse
 from datetime import datetime
+from params_diff import ParamsDiffer
 
 def monitor_device(device_index=2, check_interval=5):
     """
@@ -28,8 +29,8 @@ def monitor_device(device_index=2, check_interval=5):
     print("Press Ctrl+C to stop monitoring.")
     print("-" * 50)
     
-    # Store the previous state to detect changes
-    previous_state = None
+    # Cached per-field state, only the fields that changed are reported
+    differ = ParamsDiffer()
     
     try:
         while True:
@@ -41,13 +42,15 @@ def monitor_device(device_index=2, check_interval=5):
                 continue
                 
             current_device = devices[device_index]
-            current_state = current_device['params']['switch']
             
-            # If this is the first check or the state has changed
-            if previous_state is None or previous_state != current_state:
+            # On the first check every field is reported, afterwards only the changed ones
+            for event in differ.apply_device(current_device):
+                if event.field == 'switch':
+                    label = 'Switch' if event.outlet is None else f"Outlet {event.outlet + 1}"
+                else:
+                    label = event.field
                 timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                print(f"[{timestamp}] {name}: Switch is {current_state.upper()}")
-                previous_state = current_state
+                print(f"[{timestamp}] {name}: {label} is {str(event.new).upper()}")
             
             # Wait before checking again
             time.sleep(check_interval)
@@ -0,0 +1,130 @@
+import threading
+from collections import namedtuple
+
+# A single field (or a single outlet of a multi-channel field) that changed value.
+# outlet is None for whole-device fields such as `switch`, `rssi` or `online`.
+ChangeEvent = namedtuple('ChangeEvent', ['deviceid', 'field', 'outlet', 'old', 'new'])
+
+# Compiled per-uiid schema:
+#   scalars - params keys compared as a single value
+#   lists   - params keys holding a per-outlet list, mapped to the item key to compare
+#             e.g. 'switches': [{'switch': 'on', 'outlet': 0}, ...] -> ('switch', outlet)
+FieldSchema = namedtuple('FieldSchema', ['scalars', 'lists'])
+
+# Fields tracked for every device (single-channel devices report `switch`, multi-channel ones `switches`)
+COMMON_FIELDS = ('switch', 'rssi', 'online', 'fwVersion', 'lock')
+COMMON_LISTS = {'switches': 'switch'}
+
+# Extra fields for specific device types, on top of the common ones
+UIID_FIELDS = {
+    154: ('battery',),  # DW2 Wi-Fi door/window sensor
+}
+
+
+def compile_schema(uiid=None):
+    """Build the field schema for a device type (None = unknown type, common fields only)"""
+    # a tuple keeps the order of the events stable (switch first)
+    scalars = COMMON_FIELDS + tuple(field for field in UIID_FIELDS.get(uiid, ()) if field not in COMMON_FIELDS)
+    return FieldSchema(scalars, dict(COMMON_LISTS))
+
+
+# Schemas are shared by every device of the same uiid, compile each one only once
+_SCHEMAS = {}
+
+
+def get_schema(uiid=None):
+    schema = _SCHEMAS.get(uiid)
+    if schema is None:
+        schema = _SCHEMAS[uiid] = compile_schema(uiid)
+    return schema
+
+
+class ParamsDiffer:
+    """
+    Compare incoming device `params` against the cached state, field by field and
+    outlet by outlet, and return only what changed.
+
+    Only the schema's fields are looked up in the incoming params, so an update costs
+    a handful of lookups, not work proportional to the size of the device document
+    or of the fleet. The params are never iterated, so the static metadata of catalog
+    devices (see device_catalog.LazyDict) is never loaded.
+    """
+
+    def __init__(self):
+        self._state = {}    # deviceid -> {(field, outlet): value}
+        self._schemas = {}  # deviceid -> FieldSchema
+        self._lock = threading.Lock()
+
+    def seed(self, device):
+        """Load a device from the REST device list without emitting events"""
+        self._diff_device(device, emit=False)
+
+    def apply_device(self, device):
+        """Diff a full device from the REST device list (used by polling / reconcile)"""
+        return self._diff_device(device, emit=True)
+
+    def apply_message(self, data):
+        """Diff a websocket `update` / `sysmsg` message"""
+        deviceid = data.get('deviceid')
+        params = data.get('params')
+        if not deviceid or not isinstance(params, dict):
+            return []
+        return self._diff(deviceid, params, data.get('uiid'))
+
+    def get(self, deviceid, field, outlet=None):
+        """Return the cached value of a field (None if unknown)"""
+        state = self._state.get(deviceid)
+        if state is None:
+            return None
+        return state.get((field, outlet))
+
+    def snapshot(self, deviceid):
+        """Return a copy of the cached state of a device as {(field, outlet): value}"""
+        with self._lock:
+            return dict(self._state.get(deviceid, {}))
+
+    def _diff_device(self, device, emit):
+        deviceid = device.get('deviceid')
+        if not deviceid:
+            return []
+
+        # `online` lives at the top level of the REST device, but inside params in `sysmsg`
+        extra = (('online', device['online']),) if 'online' in device else ()
+        return self._diff(deviceid, device.get('params') or {}, device.get('uiid'), extra, emit)
+
+    def _diff(self, deviceid, params, uiid=None, extra=(), emit=True):
+        events = []
+
+        with self._lock:
+            schema = self._schemas.get(deviceid)
+            if schema is None or (uiid is not None and schema is not get_schema(uiid)):
+                schema = self._schemas[deviceid] = get_schema(uiid)
+            state = self._state.setdefault(deviceid, {})
+
+            for field in schema.scalars:
+                if field in params:
+                    self._compare(state, events, deviceid, field, None, params[field])
+            for field, value in extra:
+                if field in schema.scalars:
+                    self._compare(state, events, deviceid, field, None, value)
+
+            for field, item_field in schema.lists.items():
+                value = params.get(field)
+                if not isinstance(value, list):
+                    continue
+
+                for index, item in enumerate(value):
+                    if isinstance(item, dict) and item_field in item:
+                        outlet = item.get('outlet', index)
+                        self._compare(state, events, deviceid, item_field, outlet, item[item_field])
+
+        return events if emit else []
+
+    @staticmethod
+    def _compare(state, events, deviceid, field, outlet, value):
+        key = (field, outlet)
+        old = state.get(key)
+        if key in state and old == value:
+            return
+        state[key] = value
+        events.append(ChangeEvent(deviceid, field, outlet, old, value))
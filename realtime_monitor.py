@@ -1,4 +1,4 @@
-import sonoff
+import sonoff_backup as sonoff  # patched client (see README), replaces the sonoff-python package
 import config
 import time
 import json
@@ -9,12 +9,19 @@ from datetime import datetime
 from websocket import WebSocketApp, enableTrace
 import ssl
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from params_diff import ParamsDiffer
+from rule_engine import RuleEngine
+from telemetry import TelemetrySampler, switch_state
+from liveness import LivenessDetector
+from device_catalog import DeviceCatalog
+from traffic_capture import TrafficRecorder, WS_IN, WS_OUT, REST
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class SonoffMonitor:
-    def __init__(self, username, password, api_region, device_index=2):
+    def __init__(self, username, password, api_region, device_index=2, rules_file=None, record_file=None, catalog_file=None):
         self.username = username
         self.password = password
         self.api_region = api_region
@@ -28,59 +35,262 @@ class SonoffMonitor:
         self.last_state = None
         self.reconnect_count = 0
         self.max_reconnect_delay = 60  # Maximum reconnect delay in seconds
-        self.ping_interval = 25  # Send ping every 25 seconds to keep connection alive
-        self.last_ping_time = 0
+        self.liveness = LivenessDetector(self.send_ping, self.on_stall)  # Adaptive ping / stall detection
         self.last_successful_connection = 0
         self.connection_stable = False
         self.fallback_to_polling = False
+        self.differ = ParamsDiffer()  # Cached per-field state of every device
+        self.rules_file = rules_file
+        self.rules = None  # In-process automation rules evaluated on state changes
+        self.telemetry = TelemetrySampler()  # rssi / online / switch history of the whole fleet
+        self.clock = time.time  # Time of the telemetry samples (the capture time when replaying)
+        self.snapshot_loaded = False  # Device events are buffered until the device list is loaded
+        self.early_messages = []
+        self.snapshot_lock = threading.Lock()
+        self.bootstrap_started = None
+        self.timings = {}  # Seconds from the start of the bootstrap to each milestone
+        self.recorder = TrafficRecorder(record_file) if record_file else None  # Capture of the traffic for replay
+        self.catalog_file = catalog_file  # On-disk device catalog, also used to start from the last known devices
+        self.catalog = None
         
-    def initialize(self):
-        """Initialize the Sonoff connection and get device information"""
+    def bootstrap(self):
+        """
+        Log in, then download the device list and open the websocket in parallel.
+        Events arriving before the device list is loaded are buffered and replayed.
+        With a catalog, monitoring starts from the last known devices before the login,
+        the events are still buffered until the downloaded list has been reconciled
+        (it may have been built before them).
+        """
         print('Initializing Sonoff connection...')
-        self.sonoff = sonoff.Sonoff(self.username, self.password, self.api_region)
+        self.bootstrap_started = time.monotonic()
+        self.catalog = DeviceCatalog(self.catalog_file) if self.catalog_file else None
+        self.sonoff = sonoff.Sonoff(self.username, self.password, self.api_region, connect=False, catalog=self.catalog)
         
-        # Get initial device information
-        devices = self.sonoff.get_devices()
+        # Start from the devices stored in the catalog, the downloaded list is reconciled afterwards.
+        # No revalidation here, the login below downloads the devices anyway
+        preloaded = False
+        age = self.sonoff.get_devices_age()
+        if age is not None:
+            cached = self.sonoff.get_devices_snapshot(revalidate=False).devices
+            if len(cached) > self.device_index:
+                print(f"Loaded {len(cached)} devices from the catalog ({age:.0f} seconds old)")
+                preloaded = self.load_snapshot(cached, drain=False)
+        
+        if not self.sonoff.login():
+            print("Error: Login failed.")
+            return False
+        self.mark('login')
+        
+        self.running = True
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            devices_future = pool.submit(self.sonoff.update_devices)
+            websocket_future = pool.submit(self.open_websocket)
+            
+            devices = devices_future.result()
+            self.mark('devices')
+            if self.recorder:
+                self.recorder.record(REST, {'devicelist': devices})
+            try:
+                websocket_started = websocket_future.result()
+            except Exception as e:
+                logging.error(f"Error opening WebSocket: {e}")
+                websocket_started = False
+        
+        if preloaded:
+            # the changes made while we were away are reported, but they're old news for the rules
+            self.reconcile(devices, "start-up", run_rules=False)
+            self.drain_early_messages()
+        elif not self.load_snapshot(devices):
+            self.running = False
+            if self.ws:
+                self.ws.close()
+            return False
+        
+        if not websocket_started:
+            print("Failed to start WebSocket connection. Falling back to polling only.")
+            self.fallback_to_polling = True
+        return True
+    
+    def open_websocket(self):
+        """Look up the websocket host and connect"""
+        self.sonoff.set_wshost()
+        return self.start_websocket()
+    
+    def mark(self, milestone):
+        """Record the time from the start of the bootstrap to a milestone (first time only), True if recorded"""
+        if self.bootstrap_started is None or milestone in self.timings:
+            return False
+        self.timings[milestone] = time.monotonic() - self.bootstrap_started
+        logging.debug(f"Bootstrap: {milestone} after {self.timings[milestone]:.3f}s")
+        return True
+    
+    def load_snapshot(self, devices, drain=True):
+        """Load the device list, then process the events buffered while it was downloading (unless drain is False)"""
         if not devices or len(devices) <= self.device_index:
             print(f"Error: Device at index {self.device_index} not found.")
             return False
         
+        loads = self.catalog_loads()
+        for device in devices:
+            self.differ.seed(device)
+            self.telemetry.record_device(device, now=self.clock())
+        self.check_catalog_loads(loads, "Loading the device list")
+        
         self.device = devices[self.device_index]
         self.device_id = self.device['deviceid']
         self.name = self.device['name']
-        self.last_state = self.device['params']['switch']
+        self.last_state = self.differ.get(self.device_id, 'switch')
         
         print(f"Monitoring device: {self.name} (ID: {self.device_id})")
-        print(f"Initial state: {self.last_state.upper()}")
+        print(f"Initial state: {self.format_state()}")
+        
+        if self.rules_file:
+            self.rules = RuleEngine(self.switch_action, state_lookup=self.differ.get)
+            self.rules.load_rules(self.rules_file)
+            self.rules.start()
+        
+        if drain:
+            self.drain_early_messages()
         return True
     
+    def drain_early_messages(self):
+        """Process the events buffered during start-up, later events are processed as they arrive"""
+        with self.snapshot_lock:
+            for data, received_at in self.early_messages:
+                self.process_message(data, received_at)
+            if self.early_messages:
+                print(f"Processed {len(self.early_messages)} messages received during start-up")
+            self.early_messages = []
+            self.snapshot_loaded = True
+        self.mark('snapshot')
+    
+    def switch_action(self, action):
+        """
+        Execute a rule action. The update is sent on the monitor's own (already authenticated)
+        websocket, the device reply comes back through on_message. Without a connection it falls
+        back to Sonoff.switch, which opens and authenticates a new websocket for every action
+        (hundreds of milliseconds each).
+        """
+        if not (self.ws and self.ws.sock and self.ws.sock.connected):
+            self.sonoff.switch(action.state, action.deviceid, action.outlet)
+            return
+        
+        device = self.sonoff.get_device(action.deviceid)
+        if not device:
+            logging.error(f"Rule action for unknown device {action.deviceid}")
+            return
+        
+        if action.outlet is not None:
+            params = {'switches': [{'switch': action.state, 'outlet': action.outlet}]}
+        else:
+            params = {'switch': action.state}
+        
+        payload = {
+            'action': 'update',
+            'userAgent': 'app',
+            'params': params,
+            'apikey': device['apikey'],
+            'deviceid': str(action.deviceid),
+            'sequence': str(int(time.time() * 1000)),
+            'controlType': device['params'].get('controlType', 4),
+            'ts': 0
+        }
+        # this key is needed for a shared device
+        if device['apikey'] != self.sonoff.get_user_apikey():
+            payload['selfApikey'] = self.sonoff.get_user_apikey()
+        self.send(self.ws, payload)
+    
+    def handle_changes(self, events, detection_method=None, received_at=None, run_rules=True):
+        """Report state changes and evaluate the automation rules on them"""
+        self.report_changes(events, detection_method)
+        if run_rules and self.rules and events:
+            self.rules.handle(events, received_at)
+    
+    def format_state(self):
+        """Describe the switch state of the monitored device (single or multi-channel)"""
+        outlets = sorted((outlet, value) for (field, outlet), value in self.differ.snapshot(self.device_id).items()
+                         if field == 'switch' and outlet is not None)
+        if outlets:
+            return ', '.join(f"outlet {outlet + 1}: {str(value).upper()}" for outlet, value in outlets)
+        return str(self.last_state).upper()
+    
+    def report_changes(self, events, detection_method=None):
+        """Print the changes of the monitored device"""
+        for event in events:
+            if event.deviceid != self.device_id:
+                continue
+            
+            if event.field == 'switch':
+                label = 'Switch' if event.outlet is None else f"Outlet {event.outlet + 1}"
+                if event.outlet is None:
+                    self.last_state = event.new
+            else:
+                label = event.field
+            
+            new = str(event.new).upper()
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            suffix = f" (detected by {detection_method})" if detection_method else ""
+            if event.old is None:
+                print(f"[{timestamp}] {self.name}: {label} is {new}{suffix}")
+            else:
+                print(f"[{timestamp}] {self.name}: {label} changed from {str(event.old).upper()} to {new}{suffix}")
+    
     def on_message(self, ws, message):
         """Handle incoming websocket messages"""
+        received_at = time.monotonic()
+        if self.recorder:
+            self.recorder.record(WS_IN, message)
+        
+        # Reset reconnect count on successful message (a pong too, on a quiet account it's the only traffic)
+        self.reconnect_count = 0
+        self.connection_stable = True
+        self.last_successful_connection = time.time()
+        
+        # Heartbeat reply to our 'ping'
+        if message == 'pong':
+            self.liveness.on_pong(received_at)
+            return
+        self.liveness.on_receive(received_at)
+        
         try:
-            # Reset reconnect count on successful message
-            self.reconnect_count = 0
-            self.connection_stable = True
-            self.last_successful_connection = time.time()
-            
             data = json.loads(message)
+            self.mark('websocket')
             
             # Handle pong response
             if 'action' in data and data['action'] == 'pong':
-                logging.debug("Received pong from server")
+                self.liveness.on_pong(received_at)
                 return
-                
-            # Check if this is a device update message
-            if 'action' in data and data['action'] == 'update':
-                if 'deviceid' in data and data['deviceid'] == self.device_id:
-                    if 'params' in data and 'switch' in data['params']:
-                        new_state = data['params']['switch']
-                        if new_state != self.last_state:
-                            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            print(f"[{timestamp}] {self.name}: Switch changed from {self.last_state.upper()} to {new_state.upper()}")
-                            self.last_state = new_state
+            
+            # The userOnline reply carries the heartbeat interval the server expects
+            if isinstance(data.get('config'), dict) and data['config'].get('hbInterval'):
+                self.liveness.set_server_interval(data['config']['hbInterval'])
+            
+            if data.get('action') in ('update', 'sysmsg') and self.mark('first_event'):
+                logging.info(f"Time to first event: {self.timings['first_event']:.2f}s")
+            
+            if not self.snapshot_loaded:
+                with self.snapshot_lock:
+                    if not self.snapshot_loaded:
+                        self.early_messages.append((data, received_at))
+                        return
+            
+            self.process_message(data, received_at)
         except Exception as e:
             logging.error(f"Error processing message: {e}")
     
+    def process_message(self, data, received_at=None):
+        """Apply a decoded websocket message to the device state"""
+        # Check if this is a device update (state change) or sysmsg (online/offline) message
+        if data.get('action') in ('update', 'sysmsg'):
+            events = self.differ.apply_message(data)
+            # A `switches` update may carry only the outlets that changed, take the switch from the whole cached device
+            params = data.get('params')
+            switch = None
+            if isinstance(params, dict) and 'switches' in params and data.get('deviceid'):
+                switch = switch_state(self.differ.snapshot(data['deviceid']))
+            self.telemetry.record_update(data, now=self.clock(), switch=switch)
+            self.handle_changes(events, received_at=received_at)
+    
     def on_error(self, ws, error):
         """Handle websocket errors"""
         logging.error(f"WebSocket error: {error}")
@@ -131,32 +341,44 @@ class SonoffMonitor:
             'version': 8,
             'sequence': str(int(time.time() * 1000))
         }
-        ws.send(json.dumps(payload))
+        self.liveness.reset()
+        self.send(ws, payload)
+    
+    def send(self, ws, payload):
+        """Send a message on the websocket (dicts are sent as JSON)"""
+        message = payload if isinstance(payload, str) else json.dumps(payload)
+        if self.recorder:
+            self.recorder.record(WS_OUT, message)
+        ws.send(message)
+    
+    def send_ping(self):
+        """Send the heartbeat, the server answers 'ping' with 'pong'"""
+        if self.ws:
+            self.send(self.ws, 'ping')
+    
+    def on_stall(self, reason):
+        """The liveness detector found the connection dead, close it so on_close reconnects"""
+        logging.warning(f"WebSocket stalled ({reason}), resetting connection")
         
-        # Start ping thread to keep connection alive
-        ping_thread = threading.Thread(target=self.ping_websocket)
-        ping_thread.daemon = True
-        ping_thread.start()
+        # Reset reconnect count occasionally to allow fresh attempts
+        if self.reconnect_count > 20:
+            self.reconnect_count = 5
+        try:
+            if self.ws:
+                self.ws.close()
+        except Exception:
+            pass
+    
+    def quiet_limit(self):
+        """Seconds without any frame after which the connection is considered unstable (at least 60)"""
+        return max(60, self.liveness.max_idle_interval + self.liveness.max_timeout)
     
-    def ping_websocket(self):
-        """Send periodic pings to keep the WebSocket connection alive"""
-        while self.running and self.ws:
-            if time.time() - self.last_ping_time > self.ping_interval:
-                try:
-                    if self.ws and self.ws.sock and self.ws.sock.connected:
-                        # Send ping message
-                        # ส่ง ping ทุกๆ 25 วินาที เพื่อรักษาการเชื่อมต่อให้คงอยู่
-                        ping_payload = {
-                            'action': 'ping',
-                            'apikey': self.sonoff.get_user_apikey(),
-                            'sequence': str(int(time.time() * 1000))
-                        }
-                        self.ws.send(json.dumps(ping_payload))
-                        self.last_ping_time = time.time()
-                        logging.debug("Ping sent to server")
-                except Exception as e:
-                    logging.error(f"Error sending ping: {e}")
-            time.sleep(1)
+    def check_liveness(self):
+        """Drive the liveness detector while the WebSocket is connected"""
+        while self.running:
+            if not self.fallback_to_polling and self.ws and self.ws.sock and self.ws.sock.connected:
+                self.liveness.tick()
+            time.sleep(self.liveness.tick_interval)
     
     def start_websocket(self):
         """Start the websocket connection"""
@@ -184,14 +406,10 @@ class SonoffMonitor:
         )
         
         # Start WebSocket connection in a separate thread
-        wst = threading.Thread(target=self.ws.run_forever, kwargs={
-            "sslopt": sslopt,
-            "ping_interval": 30,  # Send WebSocket ping frame every 30 seconds
-            "ping_timeout": 10    # Wait 10 seconds for pong response
-        })
+        # (no WebSocket ping frames, the liveness detector sends heartbeats only when the connection is idle)
+        wst = threading.Thread(target=self.ws.run_forever, kwargs={"sslopt": sslopt})
         wst.daemon = True
         wst.start()
-        self.last_ping_time = time.time()
         return True
     
     def poll_status(self):
@@ -206,8 +424,8 @@ class SonoffMonitor:
                     # If we're in fallback mode, poll more frequently
                     # ถ้าอยู่ในโหมด fallback ให้ polling ถี่ขึ้น
                     polling_interval = 5
-                elif not self.connection_stable or (time.time() - self.last_successful_connection) > 60:
-                    # If connection is unstable or no messages for 60 seconds, poll more frequently
+                elif not self.connection_stable or (time.time() - self.last_successful_connection) > self.quiet_limit():
+                    # If connection is unstable or no messages for longer than a heartbeat, poll more frequently
                     # ถ้าการเชื่อมต่อไม่เสถียร ให้ polling ถี่ขึ้น
                     polling_interval = 10
                 else:
@@ -217,21 +435,25 @@ class SonoffMonitor:
                 
                 # Force update to get the latest device status
                 devices = self.sonoff.get_devices(force_update=True)
-                if devices and len(devices) > self.device_index:
-                    current_device = devices[self.device_index]
-                    current_state = current_device['params']['switch']
+                
+                # During an auth outage the last known devices are served while the client re-authenticates
+                age = self.sonoff.get_devices_age()
+                if age is not None and age > 2 * polling_interval:
+                    logging.warning(f"Device list is {age:.0f} seconds old, refreshing in the background")
+                
+                if devices:
+                    if self.recorder:
+                        self.recorder.record(REST, {'devicelist': devices})
+                    
+                    detection_method = "polling" if self.fallback_to_polling else "backup polling"
+                    events = self.reconcile(devices, detection_method)
                     
-                    # If the state has changed and wasn't caught by websocket
-                    if current_state != self.last_state:
-                        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        detection_method = "polling" if self.fallback_to_polling else "backup polling"
-                        print(f"[{timestamp}] {self.name}: Switch is {current_state.upper()} (detected by {detection_method})")
-                        self.last_state = current_state
-                        
                     # If we're in fallback mode, always show the current status
-                    elif self.fallback_to_polling and random.random() < 0.2:  # Show status occasionally (20% chance)
+                    if not events and self.fallback_to_polling and random.random() < 0.2:  # Show status occasionally (20% chance)
                         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        print(f"[{timestamp}] {self.name}: Switch is {current_state.upper()} (polling mode)")
+                        print(f"[{timestamp}] {self.name}: Switch is {self.format_state()} (polling mode)")
+                    
+                    self.log_fleet_health()
                         
             except Exception as e:
                 logging.error(f"Error polling status: {e}")
@@ -239,30 +461,60 @@ class SonoffMonitor:
             # Wait before checking again
             time.sleep(polling_interval)
     
+    def reconcile(self, devices, detection_method, run_rules=True):
+        """
+        Apply a full device list, only the fields that changed and weren't caught by websocket come out.
+        run_rules=False only reports them (e.g. the changes since the catalog was saved)
+        """
+        events = []
+        loads = self.catalog_loads()
+        for device in devices:
+            events.extend(self.differ.apply_device(device))
+            self.telemetry.record_device(device, now=self.clock())
+        self.check_catalog_loads(loads, f"Reconciling the device list ({detection_method})")
+        
+        self.handle_changes(events, detection_method, run_rules=run_rules)
+        return events
+    
+    def catalog_loads(self):
+        """Number of metadata reads from the catalog so far"""
+        return self.catalog.metadata_loads if self.catalog else 0
+    
+    def check_catalog_loads(self, before, what):
+        """Seeding and reconciling only use the hot fields, warn if they loaded static metadata from the catalog"""
+        loads = self.catalog_loads() - before
+        if loads:
+            logging.warning(f"{what} loaded the metadata of {loads} devices from the catalog")
+    
+    def log_fleet_health(self):
+        """Log weak-signal and flapping devices and the fleet availability"""
+        health = self.telemetry.summary(now=self.clock())
+        availability = ', '.join(f"p{p}: {v:.1%}" for p, v in health['availability'].items() if v is not None)
+        level = logging.WARNING if health['weak_signal'] or health['flapping'] else logging.DEBUG
+        logging.log(level, f"Fleet health ({health['devices']} devices): availability {availability or 'n/a'}, "
+                           f"weak signal {health['weak_signal']}, flapping {health['flapping']}")
+    
     def start_monitoring(self):
         """Start monitoring the device"""
-        if not self.initialize():
+        if not self.bootstrap():
             return
         
-        self.running = True
         print("Starting real-time monitoring...")
+        websocket = f", websocket {self.timings['websocket']:.2f}s" if 'websocket' in self.timings else ""
+        print(f"Start-up took {self.timings['snapshot']:.2f}s (login {self.timings['login']:.2f}s, "
+              f"device list {self.timings['devices']:.2f}s{websocket})")
         print("Press Ctrl+C to stop monitoring.")
         print("-" * 50)
         
-        # Start websocket connection
-        if not self.start_websocket():
-            print("Failed to start WebSocket connection. Falling back to polling only.")
-            self.fallback_to_polling = True
-        
         # Start polling as a backup
         polling_thread = threading.Thread(target=self.poll_status)
         polling_thread.daemon = True
         polling_thread.start()
         
-        # Start connection health checker
-        health_thread = threading.Thread(target=self.check_connection_health)
-        health_thread.daemon = True
-        health_thread.start()
+        # Start connection liveness checker
+        liveness_thread = threading.Thread(target=self.check_liveness)
+        liveness_thread.daemon = True
+        liveness_thread.start()
         
         try:
             # Keep the main thread alive
@@ -272,33 +524,33 @@ class SonoffMonitor:
             self.running = False
             if self.ws:
                 self.ws.close()
+            if self.rules:
+                self.rules.stop()
+                stats = self.rules.latency_stats()
+                if stats['count']:
+                    print(f"Rule event-to-action latency: p50 {stats['p50']:.2f} ms, p99 {stats['p99']:.2f} ms, max {stats['max']:.2f} ms "
+                          f"(queue wait p50 {stats['queue_p50']:.2f} ms, {stats['count']} actions)")
+            stats = self.liveness.stats()
+            rtt = f", RTT p50 {stats['rtt_p50'] * 1000:.0f} ms" if stats['rtt_p50'] is not None else ""
+            print(f"Liveness: {stats['pings_sent']} pings, {stats['stalls']} stalls{rtt}, timeout {stats['timeout']:.1f}s")
+            if self.recorder:
+                self.recorder.close()
+                print(f"Recorded {self.recorder.count} records to {self.recorder.path}")
+            if self.catalog:
+                self.catalog.close()
             print("\nMonitoring stopped.")
-            
-    def check_connection_health(self):
-        """Monitor the health of the WebSocket connection"""
-        """ตรวจสอบสุขภาพของการเชื่อมต่อ WebSocket"""
-        while self.running:
-            # If no successful connection for 2 minutes, reset connection
-            # หากไม่มีการเชื่อมต่อที่สำเร็จเป็นเวลา 2 นาที ให้รีเซ็ตการเชื่อมต่อ
-            if time.time() - self.last_successful_connection > 120 and not self.fallback_to_polling:
-                logging.warning("No successful WebSocket communication for 2 minutes, resetting connection")
-                try:
-                    if self.ws:
-                        self.ws.close()
-                except:
-                    pass
-                
-                # Reset reconnect count occasionally to allow fresh attempts
-                if self.reconnect_count > 20:
-                    self.reconnect_count = 5
-            
-            time.sleep(30)
 
 if __name__ == "__main__":
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Real-time monitor for Sonoff device switch status')
     parser.add_argument('--device-index', type=int, default=2,
                         help='Index of the device in the devices list (default: 2)')
+    parser.add_argument('--rules', default=None,
+                        help='JSON file of automation rules to run on state changes')
+    parser.add_argument('--record', default=None,
+                        help='Record the websocket and REST traffic to this file (replay with traffic_capture.py)')
+    parser.add_argument('--catalog', default=None,
+                        help='SQLite file caching the static device metadata and the last known devices')
     args = parser.parse_args()
     
     # Start monitoring with the specified parameters
@@ -306,6 +558,9 @@ if __name__ == "__main__":
         username=config.username,
         password=config.password,
         api_region=config.api_region,
-        device_index=args.device_index
+        device_index=args.device_index,
+        rules_file=args.rules,
+        record_file=args.record,
+        catalog_file=args.catalog
     )
     monitor.start_monitoring()
@@ -0,0 +1,199 @@
+import json
+import time
+import queue
+import logging
+import threading
+from collections import defaultdict, deque, namedtuple
+
+# Switch a device (or one outlet of a multi-channel device) to 'on' / 'off'
+Action = namedtuple('Action', ['deviceid', 'state', 'outlet'])
+
+# Matches any outlet when a rule doesn't specify one
+ANY_OUTLET = object()
+
+
+class Rule:
+    """
+    A declarative automation, e.g. "when device A turns on, switch B and C off":
+
+        {
+            "name": "hall light follows door",
+            "when": {"deviceid": "A", "field": "switch", "equals": "on"},
+            "then": [{"deviceid": "B", "switch": "off"},
+                     {"deviceid": "C", "switch": "off", "outlet": 1}]
+        }
+
+    `field` defaults to "switch", `outlet` (in when) defaults to any outlet and
+    `equals` defaults to any new value.
+    """
+    __slots__ = ('name', 'deviceid', 'field', 'outlet', 'equals', 'actions', 'max_per_minute', 'fired')
+
+    def __init__(self, name, deviceid, field, outlet, equals, actions, max_per_minute):
+        self.name = name
+        self.deviceid = deviceid
+        self.field = field
+        self.outlet = outlet
+        self.equals = equals
+        self.actions = actions
+        self.max_per_minute = max_per_minute
+        self.fired = deque()  # monotonic times of recent firings (rate protection)
+
+    @classmethod
+    def from_dict(cls, data, max_per_minute=30):
+        when = data['when']
+        actions = tuple(Action(str(item['deviceid']), item['switch'], item.get('outlet'))
+                        for item in data['then'])
+        return cls(
+            name=data.get('name', '{} -> {}'.format(when['deviceid'], ', '.join(a.deviceid for a in actions))),
+            deviceid=str(when['deviceid']),
+            field=when.get('field', 'switch'),
+            outlet=when.get('outlet', ANY_OUTLET),
+            equals=when.get('equals'),
+            actions=actions,
+            max_per_minute=data.get('max_per_minute', max_per_minute)
+        )
+
+    def matches(self, event):
+        if self.outlet is not ANY_OUTLET and self.outlet != event.outlet:
+            return False
+        return self.equals is None or self.equals == event.new
+
+
+class RuleEngine:
+    """
+    Evaluate rules on the state-change events of ParamsDiffer and send the
+    resulting actions through `executor(action)` (normally SonoffMonitor.switch_action).
+
+    Rules are indexed by (deviceid, field), so an event only looks at the rules
+    that care about it. Actions are executed on a worker thread so a slow switch
+    never blocks the websocket thread, one at a time: a burst of actions queues up.
+
+    `latencies` are measured from the event to the return of the executor,
+    `queue_waits` from the event to the start of the executor.
+
+    Loop protection:
+      - an action is skipped when the target is already in the wanted state
+      - a change caused by a rule action carries its chain depth, chains deeper
+        than `max_depth` are dropped
+      - each rule fires at most `max_per_minute` times per minute
+    """
+
+    def __init__(self, executor, state_lookup=None, max_depth=3, chain_window=10, max_per_minute=30):
+        self.executor = executor
+        self.state_lookup = state_lookup  # (deviceid, field, outlet) -> cached value
+        self.max_depth = max_depth
+        self.chain_window = chain_window  # seconds a rule action can take to come back as an event
+        self.max_per_minute = max_per_minute
+        self.rules = []
+        self.latencies = deque(maxlen=1000)  # event-to-action latency in seconds (executor done)
+        self.queue_waits = deque(maxlen=1000)  # event-to-executor-start in seconds
+        self._index = defaultdict(list)      # (deviceid, field) -> [Rule]
+        self._pending = {}                   # (deviceid, field, outlet) -> (depth, expires_at)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def add_rule(self, data):
+        rule = data if isinstance(data, Rule) else Rule.from_dict(data, self.max_per_minute)
+        self.rules.append(rule)
+        self._index[(rule.deviceid, rule.field)].append(rule)
+        return rule
+
+    def load_rules(self, path):
+        """Load a JSON list of rules from a file"""
+        with open(path) as f:
+            for data in json.load(f):
+                self.add_rule(data)
+        logging.info(f"Loaded {len(self.rules)} automation rules from {path}")
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run)
+            self._worker.daemon = True
+            self._worker.start()
+
+    def stop(self):
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker = None
+
+    def handle(self, events, received_at=None):
+        """Evaluate the rules for a list of ChangeEvent, return the number of actions queued"""
+        if received_at is None:
+            received_at = time.monotonic()
+        queued = 0
+
+        with self._lock:
+            for event in events:
+                rules = self._index.get((event.deviceid, event.field))
+                depth = self._chain_depth(event, received_at)
+                if not rules:
+                    continue
+
+                if depth > self.max_depth:
+                    logging.warning(f"Rule chain deeper than {self.max_depth} stopped at {event.deviceid} {event.field}={event.new}")
+                    continue
+
+                for rule in rules:
+                    if rule.matches(event) and self._allow(rule, received_at):
+                        queued += self._queue_actions(rule, depth, received_at)
+
+        return queued
+
+    def latency_stats(self):
+        """Event-to-action latency in milliseconds: count, p50, p99, max and the p50 of the queue wait"""
+        samples = sorted(self.latencies)
+        if not samples:
+            return {'count': 0, 'p50': None, 'p99': None, 'max': None, 'queue_p50': None}
+        waits = sorted(self.queue_waits)
+        return {
+            'count': len(samples),
+            'p50': samples[len(samples) // 2] * 1000,
+            'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            'max': samples[-1] * 1000,
+            'queue_p50': waits[len(waits) // 2] * 1000 if waits else None
+        }
+
+    def _chain_depth(self, event, now):
+        """Depth of the rule chain that caused this event (0 = external change)"""
+        pending = self._pending.pop((event.deviceid, event.field, event.outlet), None)
+        if pending is None or pending[1] < now:
+            return 0
+        return pending[0]
+
+    def _allow(self, rule, now):
+        """Rate protection: at most rule.max_per_minute firings per 60 seconds"""
+        while rule.fired and now - rule.fired[0] > 60:
+            rule.fired.popleft()
+        if len(rule.fired) >= rule.max_per_minute:
+            logging.warning(f"Rule '{rule.name}' rate limited ({rule.max_per_minute}/min)")
+            return False
+        rule.fired.append(now)
+        return True
+
+    def _queue_actions(self, rule, depth, received_at):
+        queued = 0
+        for action in rule.actions:
+            # Skip actions that wouldn't change anything, this also breaks most A <-> B loops
+            if self.state_lookup and self.state_lookup(action.deviceid, 'switch', action.outlet) == action.state:
+                continue
+            self._pending[(action.deviceid, 'switch', action.outlet)] = (depth + 1, received_at + self.chain_window)
+            self._queue.put((rule, action, received_at))
+            queued += 1
+        return queued
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            rule, action, received_at = item
+            self.queue_waits.append(time.monotonic() - received_at)
+            logging.info(f"Rule '{rule.name}': switching {action.deviceid} to {action.state}")
+            try:
+                self.executor(action)
+            except Exception as e:
+                logging.error(f"Error executing rule '{rule.name}': {e}")
+                continue
+            self.latencies.append(time.monotonic() - received_at)
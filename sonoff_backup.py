@@ -1,10 +1,14 @@
 # The domain of your component. Should be equal to the name of your component.
-import logging, time, hmac, hashlib, random, base64, json, socket, requests, re, string
+import logging, time, hmac, hashlib, random, base64, json, socket, requests, re, string, threading
+from collections import namedtuple
 from datetime import timedelta
 
 SCAN_INTERVAL = timedelta(seconds=60)
 HTTP_MOVED_PERMANENTLY, HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED, HTTP_NOT_FOUND = 301,400,401,404
 
+# the cached device list, how old it is (seconds) and whether it's within the wanted max staleness
+DevicesSnapshot = namedtuple('DevicesSnapshot', ['devices', 'age', 'fresh'])
+
 #_LOGGER = logging.getLogger(__name__)
 
 
@@ -14,15 +18,21 @@ def gen_nonce(length=8):
 
 class Sonoff():
     # def __init__(self, hass, email, password, api_region, grace_period):
-    def __init__(self, username, password, api_region, user_apikey=None, bearer_token=None, grace_period=600):
+    def __init__(self, username, password, api_region, user_apikey=None, bearer_token=None, max_staleness=None, connect=True, catalog=None):
 
         self._username      = username
         self._password      = password
         self._api_region    = api_region
         self._wshost        = None
 
-        self._skipped_login = 0
-        self._grace_period  = timedelta(seconds=grace_period)
+        # stale-while-revalidate: the cached devices are always served right away,
+        # a background task refreshes them (and re-authenticates) when they get too old
+        self._max_staleness = max_staleness if max_staleness is not None else int(SCAN_INTERVAL.total_seconds())
+        self._devices_updated_at = None   # time.monotonic() of the last successful device list download
+        self._revalidating  = False
+        self._token_rejected = False
+        self._next_revalidate_at = 0      # backoff after a failed revalidation
+        self._revalidate_lock = threading.Lock()
 
         self._user_apikey   = user_apikey
         self._bearer_token  = bearer_token
@@ -30,6 +40,20 @@ class Sonoff():
         self._ws            = None
         self.appid          = 'Uw83EKZFxdif7XFXEsrpduz5YyjP7nTl'
 
+        # optional on-disk catalog (device_catalog.DeviceCatalog): the static metadata of the devices
+        # stays on disk, and the last known devices are served right away until the first download
+        self._catalog       = catalog
+        if catalog:
+            devices, updated = catalog.load()
+            if devices:
+                self._devices = devices
+                self._devices_updated_at = time.monotonic() - max(0, time.time() - updated)
+
+        # connect=False leaves login(), set_wshost() and update_devices() to the caller,
+        # so the websocket and the device list can be fetched in parallel after the login
+        if not connect:
+            return
+
         if user_apikey and bearer_token:
             self.do_reconnect()
         else:
@@ -51,11 +75,19 @@ class Sonoff():
             self.do_login()
 
     def do_login(self):
+        if not self.login():
+            return
+
+        # get the websocket host
+        if not self._wshost:
+            self.set_wshost()
+
+        self.update_devices() # to get the devices list 
+
+    def login(self):
+        """Authenticate only, return True on success."""
         import uuid
 
-        # reset the grace period
-        self._skipped_login = 0
-        
         app_details = {
             'password'  : self._password,
             'version'   : '8',
@@ -115,29 +147,23 @@ class Sonoff():
             print("found new region: >>> %s <<< (you should change api_region option to this value in configuration.yaml)", self._api_region)
 
             # re-login using the new localized endpoint
-            self.do_login()
-            return
+            return self.login()
 
         elif 'error' in resp and resp['error'] in [HTTP_NOT_FOUND, HTTP_BAD_REQUEST]:
             # (most likely) login with +86... phone number and region != cn
             if '@' not in self._username and self._api_region != 'cn':
                 self._api_region    = 'cn'
-                self.do_login()
+                return self.login()
 
             else:
                 print("Couldn't authenticate using the provided credentials!")
 
-            return
+            return False
 
         self._bearer_token  = resp['at']
         self._user_apikey   = resp['user']['apikey']
         self._headers.update({'Authorization' : 'Bearer ' + self._bearer_token})
-
-        # get the websocket host
-        if not self._wshost:
-            self.set_wshost()
-
-        self.update_devices() # to get the devices list 
+        return True
 
     def set_wshost(self):
 #        r = requests.post('https://%s-disp.coolkit.cc:8080/dispatch/app' % self._api_region, headers=self._headers, verify=False)
@@ -150,26 +176,13 @@ class Sonoff():
         else:
             raise Exception('No websocket domain')
 
-    def is_grace_period(self):
-        grace_time_elapsed = self._skipped_login * int(SCAN_INTERVAL.total_seconds()) 
-        grace_status = grace_time_elapsed < int(self._grace_period.total_seconds())
-
-        if grace_status:
-            self._skipped_login += 1
-
-        return grace_status
-
     def update_devices(self):
+        """Download the device list now. If the token is rejected the cached devices are returned and a re-login runs in the background."""
 
         # the login failed, nothing to update
-        if not self._wshost:
+        if not self._bearer_token:
             return []
 
-        # we are in the grace period, no updates to the devices
-        if self._skipped_login and self.is_grace_period():          
-            print("Grace period active, no updates to the devices")            
-            return self._devices
-
         #r = requests.get('https://{}-api.coolkit.cc:8080/api/user/device'.format(self._api_region), 
         #    headers=self._headers)
         r = requests.get('https://{}-api.coolkit.cc:8080/api/user/device?lang=en&apiKey={}&getTags=1&version=6&ts=%s&nonce=%s&appid=Uw83EKZFxdif7XFXEsrpduz5YyjP7nTl&imei=%s&os=iOS&model=%s&romVersion=%s&appVersion=%s'.format(
@@ -180,25 +193,69 @@ class Sonoff():
         #print (r.status_code)
         #print (r.content)
         if 'error' in resp and resp['error'] in [HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED]:
-            # @IMPROVE add maybe a service call / switch to deactivate sonoff component
-            if self.is_grace_period():
-                print("Grace period activated!")
-
-                # return the current (and possible old) state of devices
-                # in this period any change made with the mobile app (on/off) won't be shown in HA
-                return self._devices
+            # serve the current (and possibly old) state of devices while re-authenticating
+            print("Token rejected, re-login in the background")
+            self._token_rejected = True
+            self.revalidate(relogin=True)
+            return self._devices
 
-            print("Re-login component")
-            self.do_login()
-        devices = r.json()
-        self._devices = devices['devicelist']
+        self._token_rejected = False
+        self._devices = self._catalog.store(resp['devicelist']) if self._catalog else resp['devicelist']
+        self._devices_updated_at = time.monotonic()
         return self._devices
 
-    def get_devices(self, force_update = False):
+    def revalidate(self, relogin=False):
+        """Refresh the devices (re-login first if relogin) in a background thread, at most one at a time."""
+        with self._revalidate_lock:
+            if self._revalidating or time.monotonic() < self._next_revalidate_at:
+                return False
+            self._revalidating = True
+
+        thread = threading.Thread(target=self._revalidate, args=(relogin,))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _revalidate(self, relogin):
+        updated_at = self._devices_updated_at
+        try:
+            if not relogin:
+                self.update_devices()
+            if relogin or self._token_rejected:
+                self.do_login() # refreshes the devices too
+        except Exception as e:
+            print("Failed to refresh the devices: {}".format(e))
+        finally:
+            # back off when nothing came back, so an auth or network outage isn't hammered
+            if self._devices_updated_at == updated_at:
+                self._next_revalidate_at = time.monotonic() + int(SCAN_INTERVAL.total_seconds())
+            with self._revalidate_lock:
+                self._revalidating = False
+
+    def get_devices_age(self):
+        """Seconds since the devices were last downloaded (None if never)."""
+        if self._devices_updated_at is None:
+            return None
+        return time.monotonic() - self._devices_updated_at
+
+    def get_devices_snapshot(self, max_staleness=None, revalidate=True):
+        """Return the cached devices right away with their age, revalidating in the background if they're older than max_staleness (unless revalidate is False)."""
+        if max_staleness is None:
+            max_staleness = self._max_staleness
+
+        age = self.get_devices_age()
+        fresh = age is not None and age <= max_staleness
+        if not fresh and revalidate:
+            # no token means the login failed, retry it as part of the revalidation
+            self.revalidate(relogin=not self._bearer_token)
+
+        return DevicesSnapshot(self._devices, age, fresh)
+
+    def get_devices(self, force_update = False, max_staleness = None):
         if force_update: 
             return self.update_devices()
 
-        return self._devices
+        return self.get_devices_snapshot(max_staleness).devices
 
     def get_device(self, deviceid):
         for device in self.get_devices():
@@ -272,11 +329,6 @@ class Sonoff():
     def switch(self, new_state, deviceid, outlet=None):
         """Switch on or off."""
 
-        # we're in the grace period, no state change
-        if self._skipped_login:
-            print("Grace period, no state change")
-            return (not new_state)
-
         self._ws = self._get_ws()
         
         if not self._ws:
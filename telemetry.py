@@ -0,0 +1,190 @@
+import time
+import threading
+from datetime import datetime
+
+import numpy as np
+
+
+def parse_time(value):
+    """Convert an API timestamp ('2025-07-13T02:44:05.673Z') to epoch seconds (nan if missing)"""
+    if not value:
+        return np.nan
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def switch_value(params):
+    """1 = on, 0 = off, -1 = unknown. Multi-channel devices count as on if any outlet is on"""
+    if 'switch' in params:
+        return 1 if params['switch'] == 'on' else 0
+    if 'switches' in params:
+        return 1 if any(item.get('switch') == 'on' for item in params['switches']) else 0
+    return -1
+
+
+def switch_state(state):
+    """Same as switch_value, from the cached state of a device ({(field, outlet): value}, see ParamsDiffer.snapshot)"""
+    outlets = [value for (field, outlet), value in state.items() if field == 'switch' and outlet is not None]
+    if outlets:
+        return 1 if 'on' in outlets else 0
+    if ('switch', None) in state:
+        return 1 if state[('switch', None)] == 'on' else 0
+    return -1
+
+
+class TelemetrySampler:
+    """
+    Fleet telemetry (rssi, online, switch) kept in preallocated NumPy ring buffers.
+
+    Every metric is a 2D array with one row per device and `capacity` samples per
+    row, so fleet-wide health checks are a few vectorized operations instead of
+    Python loops over the device dicts. Rows are added (and the arrays doubled)
+    only when a new device shows up.
+
+    Websocket updates are partial, the metrics they don't carry keep their last
+    known value. A `switches` update may carry only the outlets that changed, the
+    caller then passes the switch value of the whole device (see switch_state).
+    """
+
+    def __init__(self, capacity=256, max_devices=64):
+        self.capacity = capacity
+        self.rows = {}       # deviceid -> row
+        self.deviceids = []  # row -> deviceid
+        self._lock = threading.Lock()
+        self._allocate(max_devices)
+
+    def _allocate(self, max_devices):
+        shape = (max_devices, self.capacity)
+        self.ts = np.full(shape, np.nan)                        # sample time (epoch seconds)
+        self.rssi = np.full(shape, np.nan, dtype=np.float32)
+        self.online = np.zeros(shape, dtype=np.int8)
+        self.switch = np.full(shape, -1, dtype=np.int8)
+        self.head = np.zeros(max_devices, dtype=np.int64)       # next slot to write in each row
+        self.online_time = np.full(max_devices, np.nan)         # last onlineTime reported by the API
+        self.offline_time = np.full(max_devices, np.nan)        # last offlineTime reported by the API
+
+    def _grow(self):
+        old = (self.ts, self.rssi, self.online, self.switch, self.head, self.online_time, self.offline_time)
+        self._allocate(len(self.head) * 2)
+        for new, values in zip((self.ts, self.rssi, self.online, self.switch,
+                                self.head, self.online_time, self.offline_time), old):
+            new[:len(values)] = values
+
+    def _row(self, deviceid):
+        row = self.rows.get(deviceid)
+        if row is None:
+            row = len(self.deviceids)
+            if row >= len(self.head):
+                self._grow()
+            self.rows[deviceid] = row
+            self.deviceids.append(deviceid)
+        return row
+
+    def record_device(self, device, now=None):
+        """Record a sample from a device of the REST device list"""
+        params = device.get('params') or {}
+        with self._lock:
+            row = self._row(device['deviceid'])
+            self.online_time[row] = parse_time(device.get('onlineTime'))
+            self.offline_time[row] = parse_time(device.get('offlineTime'))
+            self._record(row, now, params.get('rssi'), device.get('online'), switch_value(params))
+
+    def record_update(self, data, now=None, switch=None):
+        """Record a sample from a websocket `update` / `sysmsg` message (switch overrides the value in the message)"""
+        deviceid = data.get('deviceid')
+        params = data.get('params')
+        if not deviceid or not isinstance(params, dict):
+            return
+        if switch is None:
+            switch = switch_value(params)
+        with self._lock:
+            self._record(self._row(deviceid), now, params.get('rssi'), params.get('online'), switch)
+
+    def _record(self, row, now, rssi, online, switch):
+        last = (self.head[row] - 1) % self.capacity
+        has_last = not np.isnan(self.ts[row, last])
+        slot = self.head[row] % self.capacity
+
+        self.ts[row, slot] = time.time() if now is None else now
+        self.rssi[row, slot] = rssi if rssi is not None else (self.rssi[row, last] if has_last else np.nan)
+        self.online[row, slot] = bool(online) if online is not None else (self.online[row, last] if has_last else 1)
+        self.switch[row, slot] = switch if switch != -1 else (self.switch[row, last] if has_last else -1)
+        self.head[row] += 1
+
+    def _newest(self, n):
+        """Slot of the latest sample of each device"""
+        return (self.head[:n] - 1) % self.capacity
+
+    def weak_signal(self, threshold=-80, window=600, now=None):
+        """Devices whose average rssi over the window is below the threshold"""
+        now = time.time() if now is None else now
+        with self._lock:
+            # A mean doesn't depend on the sample order, no need to unroll the rings
+            n = len(self.deviceids)
+            rssi = np.where(self.ts[:n] >= now - window, self.rssi[:n], np.nan)
+            counts = np.sum(~np.isnan(rssi), axis=1)
+            means = np.nansum(rssi, axis=1) / np.maximum(counts, 1)
+            weak = np.nonzero((counts > 0) & (means < threshold))[0]
+            return [(self.deviceids[row], float(means[row])) for row in weak]
+
+    def flapping(self, min_transitions=3, window=600, now=None):
+        """Devices whose online status changed at least `min_transitions` times in the window"""
+        now = time.time() if now is None else now
+        with self._lock:
+            n = len(self.deviceids)
+            in_window = self.ts[:n] >= now - window
+            # Compare every slot with the previous one in the ring, the pair (oldest, newest)
+            # across the write position isn't consecutive in time and is left out
+            changes = (self.online[:n] != np.roll(self.online[:n], 1, axis=1)) & in_window & np.roll(in_window, 1, axis=1)
+            changes[np.arange(n), self.head[:n] % self.capacity] = False
+            transitions = changes.sum(axis=1)
+            return [(self.deviceids[row], int(transitions[row])) for row in np.nonzero(transitions >= min_transitions)[0]]
+
+    def availability(self, window=3600, now=None):
+        """Fraction of the window each device was online (time weighted), {deviceid: fraction}"""
+        now = time.time() if now is None else now
+        with self._lock:
+            return dict(zip(self.deviceids, self._availability(now, window).tolist()))
+
+    def availability_percentiles(self, percentiles=(5, 50, 95), window=3600, now=None):
+        """Fleet-wide availability percentiles, {percentile: fraction}"""
+        now = time.time() if now is None else now
+        with self._lock:
+            values = self._availability(now, window)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return {p: None for p in percentiles}
+        return dict(zip(percentiles, np.percentile(values, percentiles).tolist()))
+
+    def _availability(self, now, window):
+        n = len(self.deviceids)
+        ts = self.ts[:n]
+        # Each sample holds until the next one in the ring, the latest one until now
+        start = np.maximum(ts, now - window)
+        end = np.roll(ts, -1, axis=1)
+        end[np.arange(n), self._newest(n)] = now
+        duration = np.where(np.isnan(start), 0, np.clip(end - start, 0, None))
+        total = duration.sum(axis=1)
+        online = (duration * self.online[:n]).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(total > 0, online / total, np.nan)
+
+    def offline_longer_than(self, seconds, now=None):
+        """Devices currently offline for more than `seconds`, based on the API offlineTime"""
+        now = time.time() if now is None else now
+        with self._lock:
+            n = len(self.deviceids)
+            offline = self.online[np.arange(n), self._newest(n)] == 0
+            since = now - self.offline_time[:n]
+            return [self.deviceids[row] for row in np.nonzero(offline & (since > seconds))[0]]
+
+    def summary(self, now=None):
+        """Fleet health in one dict, for logging"""
+        return {
+            'devices': len(self.deviceids),
+            'weak_signal': self.weak_signal(now=now),
+            'flapping': self.flapping(now=now),
+            'availability': self.availability_percentiles(now=now)
+        }
@@ -0,0 +1,197 @@
+import os
+import sys
+import gzip
+import json
+import time
+import hashlib
+import argparse
+import threading
+import contextlib
+
+from device_catalog import hot_state
+
+# Values of these keys are masked in captures
+SECRET_KEYS = frozenset(['at', 'apikey', 'selfApikey', 'devicekey', 'password', 'itCredential'])
+
+# Record kinds
+WS_IN = 'ws_in'     # websocket frame received
+WS_OUT = 'ws_out'   # websocket frame sent
+REST = 'rest'       # REST device list response
+
+
+def mask_value(value):
+    """Replace a secret with a stable token, so equal secrets stay equal (e.g. shared device apikeys)"""
+    return 'masked-' + hashlib.sha256(str(value).encode()).hexdigest()[:12]
+
+
+def mask(data):
+    """Return a copy of a decoded JSON document with the secret values masked"""
+    if isinstance(data, dict):
+        return {key: mask_value(value) if key in SECRET_KEYS else mask(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [mask(item) for item in data]
+    return data
+
+
+def mask_frame(frame):
+    """Mask a raw websocket frame, frames that aren't JSON (e.g. 'pong') are kept as they are"""
+    try:
+        data = json.loads(frame)
+    except (TypeError, ValueError):
+        return frame
+    return json.dumps(mask(data), separators=(',', ':'), ensure_ascii=False)
+
+
+class TrafficRecorder:
+    """
+    Write every websocket frame (in and out) and REST device list to a gzip
+    compressed JSON lines capture, with monotonic timestamps relative to the
+    start of the recording. Secrets are masked before they hit the disk.
+
+    Line 1 is a header, then one [seconds, kind, payload] record per line.
+
+    A device of a REST list is written in full the first time it's seen, then
+    only its hot state, so the static metadata of catalog devices isn't loaded
+    from disk on every poll.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self.count = 0
+        self._seen = set()  # deviceids already written in full
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._file.write(json.dumps({'version': 1, 'created': time.time()}) + '\n')
+
+    def record(self, kind, payload):
+        if kind == REST:
+            payload = mask(self._devicelist(payload))
+        else:
+            payload = mask_frame(payload)
+        self._write([round(time.monotonic() - self.started, 6), kind, payload])
+
+    def _devicelist(self, payload):
+        devices = []
+        for device in payload.get('devicelist') or []:
+            deviceid = device.get('deviceid')
+            devices.append(hot_state(device) if deviceid in self._seen else device)
+            self._seen.add(deviceid)
+        return dict(payload, devicelist=devices)
+
+    def _write(self, item):
+        line = json.dumps(item, separators=(',', ':'), ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path):
+    """Return the header of a capture file and its list of (seconds, kind, payload) records"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != 1:
+            raise ValueError(f"Unsupported capture version: {header.get('version')}")
+        return header, [tuple(json.loads(line)) for line in f]
+
+
+def replay(path, monitor, speed=1.0, profiler=None):
+    """
+    Feed a capture back into a SonoffMonitor.
+
+    speed: 1.0 = real time, N = N times faster, 0 / None = as fast as possible
+    profiler: optional object with enable() / disable() (e.g. cProfile.Profile),
+              enabled only around the ingest calls
+
+    The telemetry samples are timestamped with the capture time, not the replay time.
+
+    Returns the replay statistics (frames, elapsed seconds, frames per second).
+    Raises ValueError when the device list of the capture can't be loaded.
+    """
+    header, records = read_capture(path)
+    stats = {WS_IN: 0, WS_OUT: 0, REST: 0}
+    busy = 0.0
+    started = time.monotonic()
+    capture_time = header['created']
+    monitor.clock = lambda: capture_time
+
+    for t, kind, payload in records:
+        capture_time = header['created'] + t
+        if speed:
+            delay = started + t / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        stats[kind] += 1
+        if kind == WS_OUT:
+            continue
+
+        begin = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            if kind == WS_IN:
+                monitor.on_message(None, payload)
+            elif not monitor.snapshot_loaded:
+                if not monitor.load_snapshot(payload['devicelist']):
+                    raise ValueError(f"Can't load the device list of the capture (device index {monitor.device_index})")
+            else:
+                monitor.reconcile(payload['devicelist'], 'replay')
+        finally:
+            if profiler:
+                profiler.disable()
+            busy += time.perf_counter() - begin
+
+    if not monitor.snapshot_loaded:
+        raise ValueError("The capture has no device list, the websocket frames can't be applied")
+
+    stats['elapsed'] = time.monotonic() - started
+    stats['ingest_time'] = busy
+    stats['frames_per_second'] = (stats[WS_IN] + stats[REST]) / busy if busy else None
+    return stats
+
+
+if __name__ == "__main__":
+    from realtime_monitor import SonoffMonitor
+
+    parser = argparse.ArgumentParser(description='Replay a websocket capture through the realtime monitor')
+    parser.add_argument('capture', help='Capture file written with realtime_monitor.py --record')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed, 1 = real time, N = N times faster, 0 = as fast as possible (default: 1)')
+    parser.add_argument('--device-index', type=int, default=2,
+                        help='Index of the device in the devices list (default: 2)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the ingest path and print the top functions')
+    parser.add_argument('--quiet', action='store_true',
+                        help="Don't print the state changes while replaying")
+    args = parser.parse_args()
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    monitor = SonoffMonitor(username=None, password=None, api_region=None, device_index=args.device_index)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull if args.quiet else sys.stdout):
+            stats = replay(args.capture, monitor, speed=args.speed, profiler=profiler)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    fps = stats['frames_per_second']
+    print(f"Replayed {stats[WS_IN]} inbound frames, {stats[REST]} device lists and skipped {stats[WS_OUT]} outbound frames "
+          f"in {stats['elapsed']:.2f}s (ingest {stats['ingest_time'] * 1000:.1f} ms"
+          + (f", {fps:.0f} frames/s)" if fps else ")"))
+
+    if profiler and stats[WS_IN] + stats[REST]:
+        import pstats
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)